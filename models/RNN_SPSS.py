@@ -73,9 +73,9 @@ class LSTMAcousticModel(BaseSPSS):
         # Prepare inputs.
         norm_lab = features['normalised_lab']
         dur = features['dur']
-        norm_lab_at_frame_rate = utils.upsample_to_repetitions(norm_lab, dur)
-
         norm_counters = features['normalised_counters']
+        norm_lab_at_frame_rate = utils.upsample_to_repetitions(norm_lab, dur, max_repeated_len=norm_counters.shape[1])
+
         model_inputs = torch.cat((norm_lab_at_frame_rate, norm_counters), dim=-1)
 
         # Run the model.
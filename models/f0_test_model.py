@@ -75,7 +75,8 @@ class F0Model(BaseSPSS):
 
     def predict(self, features):
         # Prepare inputs.
-        norm_lab_at_frame_rate = utils.upsample_to_repetitions(features['normalised_lab'], features['dur'])
+        norm_lab_at_frame_rate = utils.upsample_to_repetitions(
+            features['normalised_lab'], features['dur'], max_repeated_len=features['normalised_counters'].shape[1])
         model_inputs = torch.cat((norm_lab_at_frame_rate, features['normalised_counters']), dim=-1)
         n_frames = features['n_frames']
 
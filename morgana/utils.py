@@ -7,6 +7,9 @@ import torch.nn as nn
 from tqdm import tqdm
 
 
+_EPOCH_REGEX = re.compile(r'.*checkpoints/epoch_(?P<epoch>\d+)(_\w+)?\.\w+')
+
+
 def listify(object_or_list):
     r"""Converts input to an iterable if it is not already one."""
     if not isinstance(object_or_list, (list, tuple)):
@@ -34,18 +37,43 @@ def format_float_tensor(tensor):
             first=tqdm.format_num(tensor[0]), second=tqdm.format_num(tensor[1]), last=tqdm.format_num(tensor[-1]))
 
 
+def _map_leaf(func, data):
+    return func(data)
+
+
+def _map_mapping(func, data):
+    return {k: map_nested(func, v) for k, v in data.items()}
+
+
+def _map_iterable(func, data):
+    return [map_nested(func, v) for v in data]
+
+
+# Handlers for the exact types most commonly found in batches, these avoid the slower `isinstance` checks on ABCs.
+_MAP_NESTED_HANDLERS = {
+    np.ndarray: _map_leaf,
+    torch.Tensor: _map_leaf,
+    str: _map_leaf,
+    dict: _map_mapping,
+    list: _map_iterable,
+    tuple: _map_iterable,
+}
+
+
 def map_nested(func, data):
     r"""Recursively applies a function on a nested data structure. Base cases: `np.ndarray` :class:`torch.Tensor`."""
+    handler = _MAP_NESTED_HANDLERS.get(type(data))
+    if handler is not None:
+        return handler(func, data)
+
     if isinstance(data, (np.ndarray, torch.Tensor)):
-        mapped = func(data)
+        mapped = _map_leaf(func, data)
 
     elif isinstance(data, Mapping):
-        mapped = {}
-        for k, v in data.items():
-            mapped[k] = map_nested(func, v)
+        mapped = _map_mapping(func, data)
 
     elif isinstance(data, Iterable) and not isinstance(data, str):
-        mapped = [map_nested(func, v) for v in data]
+        mapped = _map_iterable(func, data)
 
     else:
         mapped = func(data)
@@ -55,12 +83,7 @@ def map_nested(func, data):
 
 def infer_device(tensor):
     r"""Gets the device from a :class:`torch.Tensor` instance."""
-    if tensor.is_cuda:
-        device = 'cuda:{}'.format(tensor.get_device())
-    else:
-        device = 'cpu'
-
-    return torch.device(device)
+    return tensor.device
 
 
 def detach_batched_seqs(*sequence_features, seq_len=None, squeeze=True):
@@ -104,15 +127,14 @@ def detach_batched_seqs(*sequence_features, seq_len=None, squeeze=True):
 
 def get_epoch_from_checkpoint_path(checkpoint_path):
     r"""Extracts the epoch number from a checkpoint path of the form `.*checkpoints/epoch_(NUM)_.*.pt`"""
-    epoch_regex = re.compile(r'.*checkpoints/epoch_(?P<epoch>\d+)(_\w+)?\.\w+')
-    match = epoch_regex.match(checkpoint_path)
+    match = _EPOCH_REGEX.match(checkpoint_path)
     if match is None:
         return 0
     else:
         return int(match['epoch'])
 
 
-def sequence_mask(seq_len, max_len=None, dtype=torch.ByteTensor, device=None):
+def sequence_mask(seq_len, max_len=None, dtype=None, device=None):
     r"""Creates a sequence mask with a given type.
 
     Parameters
@@ -121,8 +143,8 @@ def sequence_mask(seq_len, max_len=None, dtype=torch.ByteTensor, device=None):
         Sequence lengths.
     max_len : int, optional
         Maximum sequence length. If None, `max(seq_len)` will be used to infer the `max_len`.
-    dtype : type or dtype
-        Type for the mask that will be returned.
+    dtype : type or dtype, optional
+        Type for the mask that will be returned. If None, the boolean mask is returned without casting.
     device : str or `torch.device`
         Name of the device to place the mask on.
 
@@ -137,11 +159,16 @@ def sequence_mask(seq_len, max_len=None, dtype=torch.ByteTensor, device=None):
     if device is None:
         device = infer_device(seq_len)
 
-    range = torch.arange(max_len).type(seq_len.dtype).to(device)
+    range = torch.arange(max_len, dtype=seq_len.dtype, device=device)
 
     mask = range[None, :] < seq_len[:, None]
+    mask = mask[:, :, None]
 
-    return mask[:, :, None].type(dtype)
+    # The comparison already gives a boolean mask, so there is no need to cast it.
+    if dtype is None or dtype is torch.bool:
+        return mask
+
+    return mask.type(dtype)
 
 
 def batched_masked_select(sequence_feature, seq_len):
@@ -159,20 +186,40 @@ def batched_masked_select(sequence_feature, seq_len):
     Returns : torch.Tensor, shape (sum(seq_len), feat_dim)
         Features from `sequence_feature` that are within each batch items sequence length.
     """
-    mask = sequence_mask(seq_len, sequence_feature.shape[1], dtype=torch.long)
+    mask = sequence_mask(seq_len, sequence_feature.shape[1])
     mask = mask.squeeze(dim=2)
 
     idxs = mask.nonzero(as_tuple=True)
     return sequence_feature[idxs]
 
 
-def both_voiced_mask(*sequence_features, dtype=torch.ByteTensor):
-    r"""Calculates whether the sequence features are non-zero at the same time."""
-    is_voiced = [~torch.eq(sequence_feature, 0.) for sequence_feature in sequence_features]
-    return torch.prod(torch.stack(is_voiced), dim=0).type(dtype)
+def both_voiced_mask(*sequence_features, dtype=None):
+    r"""Calculates whether the sequence features are non-zero at the same time.
+
+    Parameters
+    ----------
+    sequence_features : list[torch.Tensor]
+        Sequence features of the same shape, e.g. the predicted and target F0.
+    dtype : type or dtype, optional
+        Type for the mask that will be returned. If None, the boolean mask is returned without casting.
+
+    Returns
+    -------
+    both_voiced : torch.Tensor
+        Mask that is true where all sequence features are non-zero.
+    """
+    # Accumulate the mask in-place, rather than stacking and reducing the voicing of all features.
+    both_voiced = torch.ne(sequence_features[0], 0.)
+    for sequence_feature in sequence_features[1:]:
+        both_voiced.logical_and_(torch.ne(sequence_feature, 0.))
+
+    if dtype is None or dtype is torch.bool:
+        return both_voiced
+
+    return both_voiced.type(dtype)
 
 
-def upsample_to_repetitions(sequence_feature, repeats):
+def upsample_to_repetitions(sequence_feature, repeats, max_repeated_len=None):
     r"""Copies sequence items according to some number of repetitions. Functionality is the same as `np.repeat`.
 
     This is useful for upsampling phone-level linguistic features to frame-level, where `repeats` would be durations.
@@ -183,6 +230,11 @@ def upsample_to_repetitions(sequence_feature, repeats):
         Sequence feature at some lower frame-rate, this will be upsampled.
     repeats : torch.Tensor, shape (batch_size, max_seq_len, 1)
         Number of repetitions of each sequence item.
+    max_repeated_len : int, optional
+        Maximum length of the upsampled sequences. If None, `max(sum(repeats))` will be used to infer the
+        `max_repeated_len`, this requires synchronising with the device. If known beforehand (e.g. from the padded
+        length of a frame-level feature) it should be given. If `max_repeated_len` is less than `sum(repeats)` for
+        any batch item, the upsampled sequence is silently truncated.
 
     Returns
     -------
@@ -192,38 +244,31 @@ def upsample_to_repetitions(sequence_feature, repeats):
     device = infer_device(sequence_feature)
 
     batch_size = sequence_feature.shape[0]
-    max_seq_len = sequence_feature.shape[1]
-    feat_dim = sequence_feature.shape[2]
-
-    repeated_lens = torch.sum(repeats, dim=1)
-    max_repeated_len = torch.max(repeated_lens).item()
 
     # Remove the trailing single dimension axis if it exists.
-    repeats = repeats.reshape((batch_size, -1))
+    repeats = repeats.reshape((batch_size, -1)).type(torch.long)
 
-    # Pad the sequence features with an extra frame, then the index array `repeated_idxs` can be created using
-    # `np.repeat` using the value -1 for positions where we need to insert the padder.
-    padder = torch.zeros((batch_size, 1, feat_dim), dtype=sequence_feature.dtype).to(device)
-    sequence_feature_with_padder = torch.cat((sequence_feature, padder), dim=1)
+    # The cumulative repeats give the (exclusive) end position of each sequence item in the upsampled sequence.
+    cumulative_repeats = torch.cumsum(repeats, dim=1)
 
-    # The batch indexes are of shape (batch_size, max_repeated_len), with each row containing the index of that row.
-    batch_idx = torch.arange(batch_size)[:, None]
-    batch_idxs = batch_idx.repeat(1, max_repeated_len)
+    if max_repeated_len is None:
+        max_repeated_len = torch.max(cumulative_repeats[:, -1]).item()
 
-    # We create the sequence indexes such that any positions that are not modified below will index the padding frame
-    repeated_idxs = -1 * np.ones((batch_size, max_repeated_len), dtype=np.int64)
+    # Pad the sequence features with an extra frame, then the index array `repeated_idxs` can index the padder using
+    # the value `max_seq_len` for positions after the end of each batch item's repeated sequence.
+    sequence_feature_with_padder = nn.functional.pad(sequence_feature, (0, 0, 0, 1))
 
-    # For each item in the batch we use `np.repeat` to create our indices, this will vary in length for each item, so
-    # we need to ensure proper indexing of `repeated_idxs` is done using `repeated_len`.
-    seq_feats_idx = np.arange(max_seq_len)
-    for b, (repeat, repeated_len) in enumerate(zip(repeats.cpu(), repeated_lens.cpu())):
-        repeated_idxs[b, :repeated_len] = np.repeat(seq_feats_idx, repeat)
+    # The batch indexes are of shape (batch_size, 1), these are broadcast against `repeated_idxs` when indexing.
+    batch_idx = torch.arange(batch_size, device=device)[:, None]
 
-    repeated_idxs = torch.tensor(repeated_idxs).to(device)
+    # For each upsampled position, the index of the sequence item it repeats is the number of sequence items that end
+    # at or before that position. Positions beyond the end of the repeated sequence give `max_seq_len`, the padder.
+    positions = torch.arange(max_repeated_len, device=device).repeat(batch_size, 1)
+    repeated_idxs = torch.searchsorted(cumulative_repeats, positions, right=True)
 
-    # Now we can easily index our PyTorch tensor using the indexes created in NumPy. This will have no interaction with
-    # actual values, since it is creating a view to the original tensor, so using NumPy has no effect on backprop.
-    upsampled_sequence_feature = sequence_feature_with_padder[batch_idxs, repeated_idxs]
+    # Now we can easily index our PyTorch tensor using the indexes created above. This will have no interaction with
+    # actual values, since the indexes are integer tensors, so creating them has no effect on backprop.
+    upsampled_sequence_feature = sequence_feature_with_padder[batch_idx, repeated_idxs]
 
     return upsampled_sequence_feature
 
@@ -265,17 +310,22 @@ def split_to_segments(sequence_feature, segment_lens):
     batch_idx = torch.arange(batch_size)[:, None, None]
     batch_idxs = batch_idx.repeat(1, max_num_segments, max_segment_len)
 
-    # Create indexes such that positions that are not modified below will index the padding frame.
-    segment_idxs = -1 * np.ones((batch_size, max_num_segments, max_segment_len), dtype=np.int64)
+    # Create indexes such that positions that are not modified below will index the padding frame. On GPU the buffer is
+    # allocated in page-locked memory, so the host to device transfer can be asynchronous without an extra host copy.
+    segment_idxs = torch.empty((batch_size, max_num_segments, max_segment_len), dtype=torch.long,
+                               pin_memory=(device.type == 'cuda'))
+    segment_idxs.fill_(-1)
 
-    # Populate the `segment_idxs` tensor with indices corresponding to the length of all segments in each batch item.
+    # Populate the `segment_idxs` tensor with indices corresponding to the length of all segments in each batch item,
+    # writing through a NumPy view that shares memory with the tensor.
+    segment_idxs_np = segment_idxs.numpy()
     for b, segment_len in enumerate(segment_lens.cpu()):
         seq_idx = 0
         for seg_idx, seg_len in enumerate(segment_len):
-            segment_idxs[b, seg_idx, :seg_len] = np.arange(seq_idx, seq_idx + seg_len, dtype=np.int64)
+            segment_idxs_np[b, seg_idx, :seg_len] = np.arange(seq_idx, seq_idx + seg_len, dtype=np.int64)
             seq_idx += seg_len
 
-    segment_idxs = torch.tensor(segment_idxs).to(device)
+    segment_idxs = segment_idxs.to(device, non_blocking=True)
 
     # Now we can easily index our PyTorch tensor using the indexes created in NumPy. This will have no interaction with
     # actual values, since it is creating a view to the original tensor, so using NumPy has no effect on backprop.
@@ -362,33 +412,15 @@ class RecurrentCuDNNWrapper(nn.Module):
                 raise ValueError('If no seq_len is provided to RecurrentCuDNNWrapper the data must be already packed'
                                  f'or must be for one time slice only. For non-packed input got shape, {inputs.shape}')
 
-        # Sort the batch items by sequence length and pack the sequence.
-        sorted_idxs = torch.argsort(seq_len, descending=True)
-        sorted_inputs = inputs[sorted_idxs, ...]
-        sorted_seq_len = seq_len[sorted_idxs]
-        packed_inputs = nn.utils.rnn.pack_padded_sequence(sorted_inputs, sorted_seq_len, batch_first=True)
-
-        # Sort the initial hidden state of each batch item by sequence length.
-        if hidden is not None:
-            # Hidden shape is (num_layers * num_directions, batch_size, hidden_size).
-            if self.layer.mode == 'LSTM':
-                hidden = (hidden[0][:, sorted_idxs, :], hidden[1][:, sorted_idxs, :])
-            else:
-                hidden = hidden[:, sorted_idxs, :]
+        # Pack the sequence, the sorting of batch items by sequence length is handled by PyTorch. This includes the
+        # sorting of the initial hidden state and the unsorting of the final hidden state, using `sorted_indices`.
+        packed_inputs = nn.utils.rnn.pack_padded_sequence(inputs, seq_len.cpu(), batch_first=True, enforce_sorted=False)
 
         # Run the recurrent layer.
         packed_outputs, hidden = self.layer(packed_inputs, hx=hidden)
 
-        # Unpack and unsort the outputs.
-        sorted_outputs, _ = nn.utils.rnn.pad_packed_sequence(packed_outputs, batch_first=True)
-        unsorting_idxs = torch.argsort(sorted_idxs)
-        outputs = sorted_outputs[unsorting_idxs, ...]
-
-        # Unsort the final hidden state of each batch item.
-        if self.layer.mode == 'LSTM':
-            hidden = (hidden[0][:, unsorting_idxs, :], hidden[1][:, unsorting_idxs, :])
-        else:
-            hidden = hidden[:, unsorting_idxs, :]
+        # Unpack the outputs, this restores the original order of the batch items.
+        outputs, _ = nn.utils.rnn.pad_packed_sequence(packed_outputs, batch_first=True)
 
         return outputs, hidden
 
@@ -440,6 +472,42 @@ class ExponentialMovingAverage(object):
                 # The following is necessary, as `self.model` is a separate EMA model.
                 # self.shadow[name] = param.data.clone()
 
+        self._pool_shadow_params()
+
+        # Keep the shadow parameters in a fixed order, so all parameters can be updated by one call to a fused kernel.
+        self._names = list(self.shadow.keys())
+        self._shadow_list = [self.shadow[name] for name in self._names]
+
+    def _pool_shadow_params(self):
+        """Moves the shadow parameters into one contiguous buffer per dtype and device, for cache-friendly updates.
+
+        Each parameter of `self.model` is replaced by a view into the buffer, so `self.shadow` still links to the
+        parameters of the averaged model. Parameters of recurrent layers are left in place, as cuDNN expects these to be
+        in its own flattened weight buffer.
+        """
+        recurrent_param_names = set()
+        for module_name, module in self.model.named_modules():
+            if isinstance(module, nn.RNNBase):
+                recurrent_param_names.update(name for name, _ in module.named_parameters(prefix=module_name))
+
+        grouped_params = {}
+        for name, param in self.model.named_parameters():
+            if name in self.shadow and name not in recurrent_param_names:
+                grouped_params.setdefault((param.dtype, param.device), []).append((name, param))
+
+        for (dtype, device), named_params in grouped_params.items():
+            pool = torch.empty(sum(param.numel() for _, param in named_params), dtype=dtype, device=device)
+
+            offset = 0
+            for name, param in named_params:
+                pooled_param = pool[offset:offset + param.numel()].view_as(param)
+                pooled_param.copy_(param.data)
+
+                param.data = pooled_param
+                self.shadow[name] = pooled_param
+
+                offset += param.numel()
+
     def _update_param(self, name, x):
         """Performs update on one parameter. `shadow = decay * shadow + (1 - decay) * x`."""
         assert name in self.shadow
@@ -451,9 +519,17 @@ class ExponentialMovingAverage(object):
         """Updates all parameters of `self.model` using a separate model's updated parameters."""
         assert other_model is not self.model
 
-        for name, param in other_model.named_parameters():
-            if name in self.shadow:
-                self._update_param(name, param.data)
+        # Older versions of PyTorch do not have the fused multi-tensor kernels, so update one parameter at a time.
+        if not hasattr(torch, '_foreach_lerp_'):
+            for name, param in other_model.named_parameters():
+                if name in self.shadow:
+                    self._update_param(name, param.data)
+            return
+
+        # `lerp` computes `shadow + (1 - decay) * (x - shadow)`, which is equivalent to the update in `_update_param`.
+        other_params = dict(other_model.named_parameters())
+        param_list = [other_params[name].data for name in self._names]
+        torch._foreach_lerp_(self._shadow_list, param_list, 1.0 - self.decay)
 
     # The following is not necessary, as `morgana.experiment_builder.ExperimentBuilder` creates a separate EMA model.
     # def clone_average_model(self):
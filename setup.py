@@ -14,7 +14,7 @@ setup(
         'numpy',
         'scipy',
         'tensorboardX',
-        'torch>1.2',
+        'torch>=1.6',
         'tqdm',
     ],
     packages=['morgana'])